@@ -3,17 +3,38 @@ import psycopg2
 from dotenv import load_dotenv
 import numpy as np
 import pandas as pd
-import gower
 import hdbscan
+import copy
+import hashlib
+import io
 import json
+import random
 import requests
 import time # For exponential backoff placeholder
 
+from concurrent.futures import ThreadPoolExecutor
+
 # --- Key Imports from Scikit-learn ---
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.linear_model import LogisticRegression
 from sklearn.compose import ColumnTransformer
 from sklearn.exceptions import NotFittedError
+from sklearn.multiclass import OneVsRestClassifier
+
+try:
+    # Numba-JIT HDBSCAN (KD-tree MST, subquadratic) - optional fast path
+    import fast_hdbscan
+except ImportError:
+    fast_hdbscan = None
+
+try:
+    # RAPIDS GPU HDBSCAN - optional, only worth the host->device copy for
+    # large mistake histories (requires a CUDA build of cuml/cupy)
+    import cuml
+    import cupy
+except ImportError:
+    cuml = None
+    cupy = None
 
 from openai import OpenAI
 from openai.types.chat import ChatCompletionToolParam
@@ -21,8 +42,44 @@ from openai.types.chat import ChatCompletionToolParam
 from . import db_helpers # Use relative import
 
 # --- LLM Configuration ---
-client = OpenAI() 
+client = OpenAI()
 LLM_MODEL = "gpt-5-mini"
+LLM_MAX_CONCURRENCY = 8 # Bound on simultaneous OpenAI calls
+LLM_BATCH_THRESHOLD = 8 # Use the Batch API (50% cheaper) at this many habits or more
+
+LLM_FALLBACK_FEEDBACK = {
+    'habit_name': 'LLM Error Fallback',
+    'feedback': 'The AI coach could not generate personalized feedback. Please check the API status.',
+    'tip': 'Review the cluster manually.'
+}
+
+# Desired output structure (Tool/Function Calling). Static, so built once
+# instead of per call; shared between the live path and the Batch API path.
+LLM_TOOLS: list[ChatCompletionToolParam] = [
+    {
+        "type": "function",
+        "function": {
+            "name": "generate_habit_feedback",
+            "description": "Generates a habit name, coaching feedback, and an improvement tip for a chess player.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "habit_name": {"type": "string", "description": "A short, unique, descriptive name for the habit (max 6 words)."},
+                    "feedback": {"type": "string", "description": "A friendly coaching insight (1-2 sentences) explaining the cause of the habit."},
+                    "tip": {"type": "string", "description": "One concrete improvement tip to correct the habit, addressing the strongest action trigger."},
+                },
+                "required": ["habit_name", "feedback", "tip"],
+            },
+        }
+    }
+]
+
+LLM_SYSTEM_PROMPT = (
+    "You are a friendly, encouraging, non-judgmental chess coach AI. "
+    "Your task is to analyze a player's recurring mistake pattern based on ML clustering. "
+    "Use the provided statistical context (Cluster Summary and L1 Triggers) to make your advice specific. "
+    "You MUST output the result by calling the 'generate_habit_feedback' function."
+)
 
 # --- 1. Feature Definitions ---
 
@@ -44,6 +101,13 @@ ACTION_TRIGGERS = [
     'piece_was_defending_', 'piece_was_pinned_', 'king_self_safety_', 'king_opponent_status_'
 ]
 
+# Columns summarized (top-3 counts) for the LLM prompt
+SUMMARY_COLS = ['mistake_type', 'game_phase', 'piece_moved', 'mistake_category']
+
+# Row count below which the GPU clustering path is not worth the
+# host->device transfer and kernel-launch overhead.
+CUML_MIN_ROWS = 5000
+
 # Note: The manual TRANSLATIONS dict is removed as the LLM handles the natural language generation.
 
 # --- 2. Main Analysis Pipeline ---
@@ -59,18 +123,41 @@ def main_analysis_pipeline(user_id, conn):
     """
     
     with conn.cursor() as cur:
+        # 0. Cheap short-circuits before touching any existing analysis:
+        # a COUNT(*) avoids fetching rows for users with too little data,
+        # and a fingerprint match means nothing changed since the last run.
+        total_mistakes = db_helpers.count_mistakes_for_user(cur, user_id)
+        if total_mistakes < 20:
+            print("Not enough mistakes to run analysis (need >= 20).")
+            return {"new_habits_found": 0, "total_mistakes": total_mistakes}
+
+        # Get all mistake data, streamed into per-column lists so the
+        # DataFrame constructor gets columnar input directly
+        mistake_columns = db_helpers.get_all_mistakes_for_user_v6(cur, user_id)
+        total_mistakes = len(mistake_columns['id'])
+
+        # Re-check after the fetch: a query error returns empty columns
+        # even though the COUNT gate passed, and clustering an empty
+        # DataFrame would blow up downstream.
+        if total_mistakes < 20:
+            print("Not enough mistakes fetched to run analysis (need >= 20).")
+            return {"new_habits_found": 0, "total_mistakes": total_mistakes}
+
+        df = pd.DataFrame(mistake_columns).set_index('id')
+
+        # Clean the categorical block ONCE (stringify, fill NAs, encode as
+        # category); every downstream helper assumes this form instead of
+        # re-running .astype(str).fillna('None') over the full block.
+        df[CATEGORICAL_COLS] = df[CATEGORICAL_COLS].astype('string').fillna('None').astype('category')
+
+        fingerprint = _pipeline_fingerprint(df)
+        if fingerprint == db_helpers.get_pipeline_fingerprint(cur, user_id):
+            print("Mistake set unchanged since last run; keeping existing habits.")
+            return {"new_habits_found": 0, "total_mistakes": total_mistakes, "skipped": True}
+
         # 1. Clear old habits and feedback
         db_helpers.clear_old_habits_and_feedback(cur, user_id)
-        
-        # 2. Get all mistake data
-        all_mistakes = db_helpers.get_all_mistakes_for_user_v6(cur, user_id)
-        
-        if len(all_mistakes) < 20: 
-            print("Not enough mistakes to run analysis (need >= 20).")
-            return {"new_habits_found": 0, "total_mistakes": len(all_mistakes)}
-            
-        df = pd.DataFrame(all_mistakes).set_index('id') 
-        
+
         # 3. Step 1 (v9): Habit Discovery (HDBSCAN)
         print(f"\n--- Running Step 1: Habit Discovery (HDBSCAN) on {len(df)} mistakes ---")
         df_clustered = _run_hdbscan_clustering(df)
@@ -81,7 +168,7 @@ def main_analysis_pipeline(user_id, conn):
         
         if habits_df.empty:
             print("HDBSCAN found no significant habits. Only noise.")
-            return {"new_habits_found": 0, "total_mistakes": len(all_mistakes)}
+            return {"new_habits_found": 0, "total_mistakes": total_mistakes}
 
         print(f"HDBSCAN found {habits_df['habit_id'].nunique()} habits and {len(noise_df)} noise points.")
         
@@ -91,64 +178,174 @@ def main_analysis_pipeline(user_id, conn):
         preprocessor = _create_feature_preprocessor(df)
         if preprocessor is None:
             print("Failed to create feature preprocessor. Aborting analysis.")
-            return {"new_habits_found": 0, "total_mistakes": len(all_mistakes)}
+            return {"new_habits_found": 0, "total_mistakes": total_mistakes}
 
-        new_habit_count = 0
-        
-        for hdbscan_label in habits_df['habit_id'].unique():
-            print(f"\n--- Analyzing Habit Cluster {hdbscan_label} ---")
-            cluster_df = habits_df[habits_df['habit_id'] == hdbscan_label]
-            
-            # Use "One-vs-All" (Habit vs. All Other Mistakes, including noise)
-            control_df = df_clustered[df_clustered['habit_id'] != hdbscan_label]
-            
-            model, feature_names = _find_triggers_for_cluster(cluster_df, control_df, preprocessor)
-            
+        # Transform the full dataset ONCE; each habit's one-vs-all problem
+        # shares this matrix.
+        X_all = preprocessor.transform(df_clustered[CATEGORICAL_COLS])
+        labels = df_clustered['habit_id'].to_numpy()
+        feature_names = np.array(
+            preprocessor.named_transformers_['cat'].get_feature_names_out(CATEGORICAL_COLS),
+            dtype=object
+        )
+        # Boolean masks per trigger category, computed once instead of
+        # substring-scanning every feature name for every habit.
+        is_context = np.array([any(f.startswith(t) for t in CONTEXT_TRIGGERS) for f in feature_names])
+        is_action = np.array([any(f.startswith(t) for t in ACTION_TRIGGERS) for f in feature_names])
+        trigger_masks = (feature_names, is_context, is_action)
+
+        habit_labels = habits_df['habit_id'].unique()
+
+        print(f"Training {len(habit_labels)} trigger models (one-vs-rest saga)...")
+        models = _find_triggers_for_clusters(X_all, labels, habit_labels)
+
+        # The summary columns are already categorical; per-cluster top-3
+        # counts are pure NumPy bincounts over their integer codes.
+        summary_cats = {col: df_clustered[col] for col in SUMMARY_COLS}
+
+        # Split the habit rows once instead of boolean-masking habits_df
+        # against every label in the loop.
+        clusters_by_label = dict(tuple(habits_df.groupby('habit_id')))
+
+        # 6. Step 3 (v9): Generate, Save, and Link.
+        # Pass 1: extract triggers/summaries for every habit with a model.
+        llm_jobs = []
+        for hdbscan_label, model in zip(habit_labels, models):
             if model is None:
                 continue
-                
-            # 6. Step 3 (v9): Generate, Save, and Link
-            new_serial_id = _generate_and_save_feedback(
-                cur, user_id, hdbscan_label, cluster_df, model, feature_names
-            )
-            
-            if new_serial_id:
-                # Link all mistakes in this cluster to the new habit ID
-                list_of_mistake_ids = cluster_df.index.tolist()
-                db_helpers.link_mistakes_to_habit(cur, new_serial_id, list_of_mistake_ids)
-                new_habit_count += 1
+            print(f"\n--- Analyzing Habit Cluster {hdbscan_label} ---")
+            cluster_df = clusters_by_label[hdbscan_label]
+            job = _build_llm_job(hdbscan_label, cluster_df, model, trigger_masks, summary_cats)
+            if job:
+                llm_jobs.append(job)
+
+        # Check the persistent feedback cache first: habits with the same
+        # statistical profile (common across re-runs) skip the LLM entirely.
+        llm_outputs = [None] * len(llm_jobs)
+        pending = []
+        for i, job in enumerate(llm_jobs):
+            job['cache_key'] = _feedback_cache_key(job)
+            cached = db_helpers.get_cached_feedback(cur, job['cache_key'])
+            if cached is not None:
+                llm_outputs[i] = cached
+            else:
+                pending.append(i)
+        print(f"Feedback cache: {len(llm_jobs) - len(pending)} hits, {len(pending)} misses.")
+
+        pending_jobs = [llm_jobs[i] for i in pending]
+
+        # Pass 2: the LLM calls are independent I/O. For large habit counts
+        # submit them as a single Batch API job (cheaper, scheduled in
+        # parallel by OpenAI); otherwise run live calls under a bounded pool.
+        if len(pending_jobs) >= LLM_BATCH_THRESHOLD:
+            print(f"Generating feedback for {len(pending_jobs)} habits via the Batch API...")
+            fresh_outputs = _generate_llm_feedback_batch(pending_jobs)
+        elif pending_jobs:
+            print(f"Generating feedback for {len(pending_jobs)} habits "
+                  f"(up to {LLM_MAX_CONCURRENCY} concurrent LLM calls)...")
+            fresh_outputs = _generate_llm_feedback_concurrently(pending_jobs)
+        else:
+            fresh_outputs = []
+
+        used_fallback = False
+        for i, llm_output in zip(pending, fresh_outputs):
+            llm_outputs[i] = llm_output
+            # Don't memoize fallback output - a later run should retry
+            if llm_output.get('habit_name') != LLM_FALLBACK_FEEDBACK['habit_name']:
+                db_helpers.store_cached_feedback(cur, llm_jobs[i]['cache_key'], llm_output)
+            else:
+                used_fallback = True
+
+        # Pass 3: accumulate every habit's rows and flush them to the DB
+        # in one batch (single habits INSERT, feedback INSERT, and
+        # mistake-link UPDATE) instead of round-tripping per habit.
+        habit_entries = [
+            _build_habit_entry(job, llm_output)
+            for job, llm_output in zip(llm_jobs, llm_outputs)
+        ]
+        new_habit_count = db_helpers.batch_save_habit_analysis(cur, user_id, habit_entries)
+
+        # Remember what this run analyzed so an unchanged mistake set can
+        # skip clustering and training entirely next time. A run that fell
+        # back to error feedback (or failed to save) must NOT be recorded:
+        # the fingerprint match would block the retry forever.
+        if used_fallback or (habit_entries and new_habit_count == 0):
+            print("Not storing pipeline fingerprint (fallback feedback or save failure); next run will retry.")
+        else:
+            db_helpers.store_pipeline_fingerprint(cur, user_id, fingerprint)
 
         print(f"\nAnalysis pipeline complete for user {user_id}")
-        return {"new_habits_found": new_habit_count, "total_mistakes": len(all_mistakes)}
+        return {"new_habits_found": new_habit_count, "total_mistakes": total_mistakes}
 
 # --- 3. Pipeline Helper Functions ---
 
+def _pipeline_fingerprint(df):
+    """
+    Stable hash over the mistake ids and every clustering feature; if it
+    matches the stored value from the prior run, re-clustering would
+    reproduce the existing habits.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(df.index.to_numpy(dtype=np.int64)).tobytes())
+    h.update(pd.util.hash_pandas_object(df[NUMERIC_COLS + CATEGORICAL_COLS], index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def _build_cluster_feature_matrix(df):
+    """
+    Builds one contiguous float32 matrix for vector-space clustering:
+    standardized numerics stacked with one-hot-encoded categoricals.
+    """
+    scaler = StandardScaler()
+    num_scaled = scaler.fit_transform(df[NUMERIC_COLS]).astype(np.float32)
+
+    encoder = OneHotEncoder(sparse_output=False, dtype=np.float32)
+    ohe_cats = encoder.fit_transform(df[CATEGORICAL_COLS])
+
+    return np.ascontiguousarray(np.hstack([num_scaled, ohe_cats]))
+
 def _run_hdbscan_clustering(df):
     """
     Prepares data and runs HDBSCAN to find clusters.
+
+    Both paths cluster the standardized-numeric + one-hot feature vectors
+    directly (Euclidean on one-hot columns matches Gower up to a scale
+    factor for binary categoricals), so the tree is built via the Boruvka
+    KD-tree MST - O(N log N) time and O(N*d) memory instead of the O(N^2)
+    precomputed-matrix path. fast_hdbscan is preferred when installed.
     """
-    df_features = df.copy()
-    
-    scaler = StandardScaler()
-    df_features[NUMERIC_COLS] = scaler.fit_transform(df_features[NUMERIC_COLS])
-    
-    for col in CATEGORICAL_COLS:
-        df_features[col] = df_features[col].astype(str).fillna('None')
-
-    print("Computing Gower distance matrix...")
-    gower_matrix = gower.gower_matrix(df_features[NUMERIC_COLS + CATEGORICAL_COLS])
-    gower_matrix_double = gower_matrix.astype(np.float64)
-
-    print("Running HDBSCAN...")
-    clusterer = hdbscan.HDBSCAN(
-        metric='precomputed',
-        min_cluster_size=5, # Find habits with as few as 5 mistakes
-        min_samples=3,
-        allow_single_cluster=False,
-        gen_min_span_tree=True
-    )
-    clusterer.fit(gower_matrix_double)
-    
+    X = _build_cluster_feature_matrix(df)
+
+    if cuml is not None and len(df) >= CUML_MIN_ROWS:
+        try:
+            print(f"Running cuml HDBSCAN on GPU for {len(df)} mistakes...")
+            clusterer = cuml.cluster.HDBSCAN(
+                min_cluster_size=5, # Find habits with as few as 5 mistakes
+                min_samples=3
+            )
+            clusterer.fit(cupy.asarray(X, dtype=cupy.float32))
+            df['habit_id'] = cupy.asnumpy(clusterer.labels_)
+            df['habit_confidence'] = cupy.asnumpy(clusterer.probabilities_)
+            return df
+        except Exception as e:
+            print(f"GPU clustering failed ({e}); falling back to CPU HDBSCAN.")
+
+    if fast_hdbscan is not None:
+        print("Running fast_hdbscan on one-hot feature vectors...")
+        clusterer = fast_hdbscan.HDBSCAN(
+            min_cluster_size=5, # Find habits with as few as 5 mistakes
+            min_samples=3
+        )
+    else:
+        print("Running HDBSCAN (Boruvka KD-tree) on one-hot feature vectors...")
+        clusterer = hdbscan.HDBSCAN(
+            min_cluster_size=5, # Find habits with as few as 5 mistakes
+            min_samples=3,
+            metric='euclidean',
+            algorithm='boruvka_kdtree',
+            core_dist_n_jobs=-1
+        )
+    clusterer.fit(X)
+
     df['habit_id'] = clusterer.labels_
     df['habit_confidence'] = clusterer.probabilities_
     return df
@@ -159,14 +356,16 @@ def _create_feature_preprocessor(df):
     categorical features for the Logistic Regression model.
     """
     try:
-        # Fill NAs and ensure string type for encoder
-        df_cat = df[CATEGORICAL_COLS].astype(str).fillna('None')
-        
+        # The categorical block is already stringified/NA-filled at ingest
+        df_cat = df[CATEGORICAL_COLS]
+
         preprocessor = ColumnTransformer(
             transformers=[
-                ('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=False), CATEGORICAL_COLS)
+                # Sparse float32 output: the one-hot matrix is ~95% zeros,
+                # and saga consumes CSR natively
+                ('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=True, dtype=np.float32), CATEGORICAL_COLS)
             ],
-            remainder='drop' 
+            remainder='drop'
         )
         
         preprocessor.fit(df_cat)
@@ -175,87 +374,65 @@ def _create_feature_preprocessor(df):
         print(f"Error creating preprocessor: {e}")
         return None
 
-def _find_triggers_for_cluster(cluster_df, control_df, preprocessor):
+def _find_triggers_for_clusters(X_all, labels, habit_labels):
     """
-    Trains a balanced L1 Logistic Regression model (Habit vs. Control).
-    """
-    positive_df = cluster_df
-    negative_df = control_df
-    
-    if negative_df.empty:
-        print("Cannot train model: No 'control' examples to compare against.")
-        return None, None
-        
-    training_df = pd.concat([positive_df, negative_df])
-    # The label is 1 if it belongs to the current cluster, 0 otherwise
-    Y_train = (training_df['habit_id'] == cluster_df['habit_id'].iloc[0]).astype(int) 
-    
-    X_train_raw = training_df[CATEGORICAL_COLS].astype(str).fillna('None')
-    
-    try:
-        X_train_processed = preprocessor.transform(X_train_raw)
-    except Exception as e:
-        print(f"Error during feature transformation: {e}")
-        return None, None
-    
-    # Get the names of the features created by the OneHotEncoder
-    feature_names = list(preprocessor.named_transformers_['cat'].get_feature_names_out(CATEGORICAL_COLS))
+    Trains all balanced L1 Logistic Regression models (Habit vs. Control)
+    in one OneVsRestClassifier pass over the shared design matrix. saga
+    reads the CSR matrix directly (no densify) and the per-class binary
+    fits run in parallel via n_jobs. The one-hot columns are already on
+    a unit scale, so no extra column scaling is needed.
 
-    model = LogisticRegression(
-        penalty='l1', 
-        solver='liblinear', 
-        class_weight='balanced', 
+    Returns a list of per-habit binary models aligned with `habit_labels`
+    (None where no model could be trained).
+    """
+    base_model = LogisticRegression(
+        penalty='l1',
+        solver='saga',
+        class_weight='balanced',
         C=1.0, # Use 1.0 for less strict regularization (more triggers)
+        max_iter=200,
         random_state=42
     )
-    model.fit(X_train_processed, Y_train)
-    
-    return model, feature_names
+
+    try:
+        # Fit against the full label vector; the noise class (-1) gets an
+        # estimator too, which we simply never look up.
+        ovr = OneVsRestClassifier(base_model, n_jobs=-1)
+        ovr.fit(X_all, labels)
+    except Exception as e:
+        print(f"Error fitting one-vs-rest trigger models: {e}")
+        return [None] * len(habit_labels)
+
+    if len(ovr.classes_) == 2 and len(ovr.estimators_) == 1:
+        # With exactly two classes OneVsRestClassifier keeps a single
+        # estimator whose positive class is classes_[1]. classes_[0] may
+        # also be a habit (two clusters, zero noise points); a binary LR
+        # for it is just the sign-flipped twin of the fitted one.
+        positive = ovr.estimators_[0]
+        flipped = copy.deepcopy(positive)
+        flipped.coef_ = -flipped.coef_
+        flipped.intercept_ = -flipped.intercept_
+        models_by_class = {ovr.classes_[1]: positive, ovr.classes_[0]: flipped}
+    else:
+        models_by_class = dict(zip(ovr.classes_, ovr.estimators_))
+
+    return [models_by_class.get(hdbscan_label) for hdbscan_label in habit_labels]
     
-def _generate_llm_feedback(context, action, confidence, cluster_summary, triggers):
+def _build_llm_messages(context, action, confidence, cluster_summary, triggers):
     """
-    Uses the OpenAI SDK and structured output feature for GPT-4o Mini
-    to generate habit name, coaching feedback, and a tip in reliable JSON format.
+    Constructs the system and user messages for one habit's feedback prompt.
     """
-    
     # Clean up the feature names for better readability in the prompt
     clean_context = context.replace("_", " ").split(" ", 1)[-1].capitalize() if context else "General Context"
     clean_action = action.replace("_", " ").split(" ", 1)[-1].capitalize() if action else "Imprecise Move"
-    
+
     # Format L1 Triggers for LLM
     trigger_list = [f"{k.split('_', 1)[-1]} (Weight: {v:.2f})" for k, v in triggers.items()]
-    
-    # --- 1. Define the desired output structure (Tool/Function Calling) ---
-    tools: list[ChatCompletionToolParam] = [
-        {
-            "type": "function",
-            "function": {
-                "name": "generate_habit_feedback",
-                "description": "Generates a habit name, coaching feedback, and an improvement tip for a chess player.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "habit_name": {"type": "string", "description": "A short, unique, descriptive name for the habit (max 6 words)."},
-                        "feedback": {"type": "string", "description": "A friendly coaching insight (1-2 sentences) explaining the cause of the habit."},
-                        "tip": {"type": "string", "description": "One concrete improvement tip to correct the habit, addressing the strongest action trigger."},
-                    },
-                    "required": ["habit_name", "feedback", "tip"],
-                },
-            }
-        }
-    ]
-    
-    # --- 2. Construct the system and user messages ---
-    system_prompt = (
-        "You are a friendly, encouraging, non-judgmental chess coach AI. "
-        "Your task is to analyze a player's recurring mistake pattern based on ML clustering. "
-        "Use the provided statistical context (Cluster Summary and L1 Triggers) to make your advice specific. "
-        "You MUST output the result by calling the 'generate_habit_feedback' function."
-    )
-    
+
+    # Compact JSON: the indented variant only inflates billed prompt tokens
     user_prompt = f"""
 HDBSCAN Cluster Summary:
-{json.dumps(cluster_summary, indent=2)}
+{json.dumps(cluster_summary, separators=(',', ':'))}
 
 L1 Model's Strongest Triggers (Statistical Context):
 - Top Context Feature: {clean_context}
@@ -267,118 +444,271 @@ Your task:
 1. Generate the content based on the data.
 2. Output the result by calling the 'generate_habit_feedback' tool.
 """
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
+
+    return [
+        {"role": "system", "content": LLM_SYSTEM_PROMPT},
         {"role": "user", "content": user_prompt}
     ]
-    
-    # --- 3. Call the OpenAI API ---
+
+def _parse_llm_tool_call(message_tool_calls):
+    """
+    Extracts and parses the 'generate_habit_feedback' arguments from a
+    completion's tool calls. Returns None if no valid call is present.
+    """
+    if not message_tool_calls:
+        return None
+    tool_call = message_tool_calls[0]
+    if tool_call.function.name != "generate_habit_feedback":
+        return None
+    # The arguments are a JSON string, which we parse
+    return json.loads(tool_call.function.arguments)
+
+def _generate_llm_feedback(context, action, confidence, cluster_summary, triggers):
+    """
+    Uses the OpenAI SDK and structured output feature for GPT-4o Mini
+    to generate habit name, coaching feedback, and a tip in reliable JSON format.
+    """
+    messages = _build_llm_messages(context, action, confidence, cluster_summary, triggers)
+
+    # --- Call the OpenAI API ---
     for attempt in range(3):
         try:
             response = client.chat.completions.create(
                 model=LLM_MODEL,
                 messages=messages,
-                tools=tools,
+                tools=LLM_TOOLS,
                 tool_choice={"type": "function", "function": {"name": "generate_habit_feedback"}}, # Force JSON output via function call
                 temperature=1,
                 timeout=30,
             )
             
             # Extract arguments from the function call
-            if response.choices and response.choices[0].message.tool_calls:
-                tool_call = response.choices[0].message.tool_calls[0]
-                if tool_call.function.name == "generate_habit_feedback":
-                    # The arguments are a JSON string, which we parse
-                    return json.loads(tool_call.function.arguments)
-            
+            if response.choices:
+                parsed = _parse_llm_tool_call(response.choices[0].message.tool_calls)
+                if parsed is not None:
+                    return parsed
+
             # If function call failed or wasn't found, fall through to error handling
             raise ValueError("LLM did not return a valid function call argument.")
 
         except Exception as e:
             if attempt < 2:
                 print(f"LLM call failed on attempt {attempt + 1}: {e}. Retrying...")
-                time.sleep(2 ** attempt)
+                # Jittered exponential backoff so concurrent retries don't
+                # hammer the API in lockstep
+                time.sleep(2 ** attempt + random.random())
             else:
                 print(f"LLM call failed after all attempts: {e}. Returning fallback feedback.")
-                # --- Fallback Feedback ---
-                return {
-                    'habit_name': 'LLM Error Fallback', 
-                    'feedback': 'The AI coach could not generate personalized feedback. Please check the API status.', 
-                    'tip': 'Review the cluster manually.'
-                }
+                return dict(LLM_FALLBACK_FEEDBACK)
 
 
-def _generate_and_save_feedback(cur, user_id, hdbscan_label, cluster_df, model, feature_names):
+def _build_llm_job(hdbscan_label, cluster_df, model, trigger_masks, summary_cats):
     """
-    Extracts triggers, calls the LLM for feedback, and saves the structured result.
+    Extracts triggers and the cluster summary for one habit, packaged as a
+    'job' dict ready for the concurrent LLM pass. Returns None when the
+    model produced no usable triggers.
     """
+    feature_names, is_context, is_action = trigger_masks
     coefficients = model.coef_[0]
+
     # Get features with a meaningful *positive* association
-    triggers = {name: coef for name, coef in zip(feature_names, coefficients) if coef > 0.1} 
-    
-    if not triggers:
+    keep = coefficients > 0.1
+    keep_idx = np.where(keep)[0]
+
+    if keep_idx.size == 0:
         print(f"No strong positive triggers found for Habit {hdbscan_label}.")
         return None
 
-    # Separate into Context and Action
-    context_triggers = {f: c for f, c in triggers.items() if any(t in f for t in CONTEXT_TRIGGERS)}
-    action_triggers = {f: c for f, c in triggers.items() if any(t in f for t in ACTION_TRIGGERS)}
+    triggers = {feature_names[i]: coefficients[i] for i in keep_idx}
 
-    top_context = max(context_triggers, key=context_triggers.get, default=None)
-    top_action = max(action_triggers, key=action_triggers.get, default=None)
+    # Separate into Context and Action via the precomputed masks
+    ctx_idx = np.where(keep & is_context)[0]
+    act_idx = np.where(keep & is_action)[0]
+
+    top_context = feature_names[ctx_idx[np.argmax(coefficients[ctx_idx])]] if ctx_idx.size else None
+    top_action = feature_names[act_idx[np.argmax(coefficients[act_idx])]] if act_idx.size else None
+
+    return {
+        'hdbscan_label': hdbscan_label,
+        'triggers': triggers,
+        'top_context': top_context,
+        'top_action': top_action,
+        'confidence': cluster_df['habit_confidence'].mean(),
+        'prime_example_id': int(cluster_df['cpl'].idxmax()),
+        'cluster_summary': _summarize_cluster_for_llm(cluster_df, summary_cats),
+        'mistake_ids': cluster_df.index.tolist(),
+    }
+
+def _feedback_cache_key(job):
+    """
+    Canonical hash of the statistical profile that drives the prompt;
+    habits with identical profiles map to the same cached feedback.
+    """
+    payload = json.dumps({
+        'c': job['top_context'],
+        'a': job['top_action'],
+        't': sorted((name, float(coef)) for name, coef in job['triggers'].items()),
+        's': job['cluster_summary'],
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode()).hexdigest()
+
+def _generate_llm_feedback_concurrently(llm_jobs):
+    """
+    Runs one `_generate_llm_feedback` call per job in a bounded thread
+    pool (the OpenAI SDK releases the GIL during I/O). Returns outputs
+    in the same order as `llm_jobs`.
+    """
+    if not llm_jobs:
+        return []
+
+    with ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY) as executor:
+        return list(executor.map(
+            lambda job: _generate_llm_feedback(
+                job['top_context'], job['top_action'], job['confidence'],
+                job['cluster_summary'], job['triggers']
+            ),
+            llm_jobs
+        ))
+
+def _generate_llm_feedback_batch(llm_jobs):
+    """
+    Submits all habit prompts as one OpenAI Batch API job (~50% cheaper
+    than live calls, scheduled in parallel on OpenAI's side) and polls
+    until completion. Falls back to the live concurrent path if the
+    batch fails or expires.
+    """
+    try:
+        batch_id = _submit_batch(llm_jobs)
+
+        # Poll with capped exponential backoff until the batch finishes.
+        delay = 5
+        while True:
+            batch = client.batches.retrieve(batch_id)
+            if batch.status == 'completed':
+                break
+            if batch.status in ('failed', 'expired', 'cancelled'):
+                raise RuntimeError(f"Batch {batch_id} ended with status '{batch.status}'")
+            print(f"Batch {batch_id} status: {batch.status}. Polling again in {delay}s...")
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+        # Download and parse the output file (one JSON line per habit,
+        # keyed by custom_id = hdbscan label).
+        output_text = client.files.content(batch.output_file_id).text
+        outputs_by_label = {}
+        for line in output_text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            try:
+                tool_call = result['response']['body']['choices'][0]['message']['tool_calls'][0]
+                outputs_by_label[result['custom_id']] = json.loads(tool_call['function']['arguments'])
+            except (KeyError, IndexError, TypeError) as e:
+                print(f"Could not parse batch result for habit {result.get('custom_id')}: {e}")
+
+        return [
+            outputs_by_label.get(str(job['hdbscan_label']), dict(LLM_FALLBACK_FEEDBACK))
+            for job in llm_jobs
+        ]
+
+    except Exception as e:
+        print(f"Batch API path failed: {e}. Falling back to live LLM calls.")
+        return _generate_llm_feedback_concurrently(llm_jobs)
+
+def _submit_batch(llm_jobs):
+    """
+    Uploads one JSONL line per habit (same messages/tools as the live
+    path) and creates the batch. Returns the batch id.
+    """
+    lines = []
+    for job in llm_jobs:
+        lines.append(json.dumps({
+            "custom_id": str(job['hdbscan_label']),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": LLM_MODEL,
+                "messages": _build_llm_messages(
+                    job['top_context'], job['top_action'], job['confidence'],
+                    job['cluster_summary'], job['triggers']
+                ),
+                "tools": LLM_TOOLS,
+                "tool_choice": {"type": "function", "function": {"name": "generate_habit_feedback"}},
+                "temperature": 1,
+            },
+        }))
+
+    batch_file = client.files.create(
+        file=io.BytesIO("\n".join(lines).encode('utf-8')),
+        purpose='batch'
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h'
+    )
+    print(f"Submitted LLM batch {batch.id} with {len(llm_jobs)} prompts.")
+    return batch.id
+
+def _build_habit_entry(job, llm_output):
+    """
+    Combines one habit's analysis data with its pre-fetched LLM output
+    into the dict shape db_helpers.batch_save_habit_analysis expects.
+    """
+    hdbscan_label = job['hdbscan_label']
 
-    habit_confidence = cluster_df['habit_confidence'].mean()
-    prime_example_id = int(cluster_df['cpl'].idxmax()) 
-    
-    # Generate Cluster Summary
-    cluster_summary = _summarize_cluster_for_llm(cluster_df)
-    
-    # --- LLM Integration Point (Live Call) ---
-    llm_output = _generate_llm_feedback(top_context, top_action, habit_confidence, cluster_summary, triggers) 
-    
     # 1. Get the LLM-suggested name
     suggested_name = llm_output.get('habit_name', 'Unnamed Habit')
 
     # 2. FIX for Unique Constraint: Append the cluster ID
-    habit_name = f"{suggested_name} (H{hdbscan_label})" 
-    
+    habit_name = f"{suggested_name} (H{hdbscan_label})"
+
     coaching_feedback = llm_output.get('feedback', 'No detailed feedback generated.')
     improvement_tip = llm_output.get('tip', 'No specific tip provided.')
-    
+
     print(f"Generated feedback for cluster {hdbscan_label} ('{habit_name}'): {coaching_feedback}")
-    
-    # Save to DB and get the new serial ID
-    new_serial_habit_id = db_helpers.save_habit_analysis(
-        cur, 
-        user_id, 
-        int(hdbscan_label), 
-        habit_name,
-        triggers,      
-        habit_confidence, 
-        prime_example_id, 
-        coaching_feedback, 
-        improvement_tip    
-    )
-    return new_serial_habit_id
 
-def _summarize_cluster_for_llm(cluster_df):
+    return {
+        'cluster_id': int(hdbscan_label),
+        'habit_name': habit_name,
+        'triggers': job['triggers'],
+        'confidence': job['confidence'],
+        'prime_example_id': job['prime_example_id'],
+        'feedback_text': coaching_feedback,
+        'improvement_tip': improvement_tip,
+        'mistake_ids': job['mistake_ids'],
+    }
+
+def _summarize_cluster_for_llm(cluster_df, summary_cats):
     """
-    Calculates the most frequent and most severe characteristics of a cluster.
+    Calculates the most frequent and most severe characteristics of a
+    cluster. `summary_cats` holds the pre-encoded categorical columns,
+    so the per-cluster top-3 is a bincount over integer codes rather
+    than a pandas value_counts per column.
     """
     summary = {}
-    
+
     summary['total_mistakes_in_habit'] = len(cluster_df)
     summary['avg_cpl'] = f"{cluster_df['cpl'].mean():.0f}"
     summary['most_severe_cpl'] = f"{cluster_df['cpl'].max():.0f}"
-    
+
     # Categorical Summary (Top 3 most frequent values for key features)
     top_n = 3
-    for col in ['mistake_type', 'game_phase', 'piece_moved', 'mistake_category']:
-        top_counts = cluster_df[col].value_counts().nlargest(top_n)
+    for col in SUMMARY_COLS:
+        cat = summary_cats[col]
+        codes = cat.cat.codes.loc[cluster_df.index].to_numpy()
+        codes = codes[codes >= 0] # -1 encodes missing values
+        counts = np.bincount(codes, minlength=len(cat.cat.categories))
+
+        if counts.size > top_n:
+            top = np.argpartition(-counts, top_n)[:top_n]
+        else:
+            top = np.arange(counts.size)
+        order = top[np.argsort(-counts[top])]
+
         summary[f'top_{col}'] = [
-            f"{val} ({count})" 
-            for val, count in top_counts.items()
+            f"{cat.cat.categories[i]} ({counts[i]})"
+            for i in order if counts[i] > 0
         ]
-        
+
     return summary
\ No newline at end of file
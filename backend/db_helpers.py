@@ -1,8 +1,19 @@
+import csv
+import io
 import psycopg2
-from psycopg2.extras import execute_values, RealDictCursor
+from psycopg2.extras import execute_values
 from datetime import datetime
 import json
 
+# Column order of the clustering SELECT in get_all_mistakes_for_user_v6.
+MISTAKE_FEATURE_COLUMNS = [
+    'id', 'cpl', 'move_number',
+    'mistake_type', 'mistake_category', 'game_phase', 'material_balance',
+    'board_complexity', 'king_self_safety', 'king_opponent_status',
+    'castling_status_self', 'piece_moved', 'move_type', 'piece_was_attacked',
+    'piece_was_defended', 'piece_was_defending', 'piece_was_pinned'
+]
+
 def get_user_by_username(cur, username):
     try:
         cur.execute("SELECT id FROM users WHERE chess_com_username = %s", (username,))
@@ -16,47 +27,73 @@ def get_user_by_username(cur, username):
         print(f"Error fetching user: {error}")
         return None
 
-def insert_game(cur, user_id, source, source_game_id, game_url, pgn_data, game_date):
-    insert_game_sql = """
-    INSERT INTO games (user_id, source, source_game_id, game_url, pgn_data, game_date)
-    VALUES (%s, %s, %s, %s, %s, %s)
-    ON CONFLICT (user_id, source, source_game_id) DO NOTHING
-    RETURNING id;
+def batch_insert_games(cur, game_rows):
+    """
+    Inserts one month's games in a single execute_values round trip.
+    Each row is (user_id, source, source_game_id, game_url, pgn_data,
+    game_date). Returns {source_game_id: game_id} for the rows actually
+    inserted; already-ingested games conflict and are omitted.
     """
+    if not game_rows:
+        return {}
+
     try:
-        cur.execute(insert_game_sql, (
-            user_id, source, source_game_id, game_url, pgn_data, game_date
-        ))
-        game_id_row = cur.fetchone()
-        
-        if game_id_row:
-            return game_id_row[0]
-        else:
-            print(f"Game {source_game_id} already exists in DB. Skipping.")
-            return None
+        inserted = execute_values(cur, """
+            INSERT INTO games (user_id, source, source_game_id, game_url, pgn_data, game_date)
+            VALUES %s
+            ON CONFLICT (user_id, source, source_game_id) DO NOTHING
+            RETURNING id, source_game_id;
+            """, game_rows, fetch=True)
+        return {source_game_id: game_id for game_id, source_game_id in inserted}
     except (Exception, psycopg2.DatabaseError) as error:
-        print(f"Error inserting game: {error}")
-        return None
+        print(f"Error batch-inserting games: {error}")
+        return {}
+
+# Insert column order for the mistakes table bulk loaders.
+MISTAKE_INSERT_COLUMNS = [
+    'game_id', 'move_number', 'player_color', 'prior_fen', 'move_made', 'best_move',
+    'cpl', 'mistake_type', 'mistake_category', 'game_phase', 'material_balance',
+    'board_complexity', 'king_self_safety', 'king_opponent_status',
+    'castling_status_self', 'piece_moved', 'move_type', 'piece_was_attacked',
+    'piece_was_defended', 'piece_was_defending', 'piece_was_pinned'
+]
+
+# Batch size at which COPY FROM STDIN beats execute_values once the CSV
+# serialization is paid for.
+COPY_MIN_ROWS = 500
 
 def batch_insert_mistakes(cur, mistakes_list_of_dicts):
+    """
+    Bulk-loads mistakes. Small batches go through one execute_values
+    INSERT; batches over COPY_MIN_ROWS rows use COPY FROM STDIN, which
+    also bypasses per-row INSERT parsing in Postgres (the mistakes table
+    has no unique constraint, so no conflict handling is needed).
+    """
     if not mistakes_list_of_dicts:
         print("No mistakes to insert.")
         return
 
-    columns = [
-        'game_id', 'move_number', 'player_color', 'prior_fen', 'move_made', 'best_move',
-        'cpl', 'mistake_type', 'mistake_category', 'game_phase', 'material_balance', 
-        'board_complexity', 'king_self_safety', 'king_opponent_status', 
-        'castling_status_self', 'piece_moved', 'move_type', 'piece_was_attacked', 
-        'piece_was_defended', 'piece_was_defending', 'piece_was_pinned'
+    rows = [
+        tuple(mistake.get(col) for col in MISTAKE_INSERT_COLUMNS)
+        for mistake in mistakes_list_of_dicts
     ]
-    
-    values_list = [tuple(mistake.get(col) for col in columns) for mistake in mistakes_list_of_dicts]
-    insert_mistakes_sql = f"INSERT INTO mistakes ({', '.join(columns)}) VALUES %s;"
-    
+
     try:
-        execute_values(cur, insert_mistakes_sql, values_list)
-        print(f"Successfully batch-inserted {len(values_list)} mistakes.")
+        if len(rows) > COPY_MIN_ROWS:
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            copy_sql = (
+                f"COPY mistakes ({', '.join(MISTAKE_INSERT_COLUMNS)}) "
+                "FROM STDIN WITH (FORMAT csv, NULL '')"
+            )
+            cur.copy_expert(copy_sql, buf)
+        else:
+            execute_values(cur, f"""
+                INSERT INTO mistakes ({', '.join(MISTAKE_INSERT_COLUMNS)})
+                VALUES %s;
+                """, rows)
+        print(f"Successfully batch-inserted {len(rows)} mistakes.")
     except (Exception, psycopg2.DatabaseError) as error:
         print(f"Error batch-inserting mistakes: {error}")
 
@@ -83,117 +120,182 @@ def clear_old_habits_and_feedback(cur, user_id):
         print(f"Error clearing old habits: {error}")
         raise
 
+def count_mistakes_for_user(cur, user_id):
+    """
+    Cheap COUNT(*) so the pipeline can bail out before fetching any rows.
+    """
+    try:
+        cur.execute(
+            "SELECT COUNT(*) FROM mistakes WHERE game_id IN (SELECT id FROM games WHERE user_id = %s)",
+            (user_id,)
+        )
+        return cur.fetchone()[0]
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error counting mistakes: {error}")
+        return 0
+
+def get_pipeline_fingerprint(cur, user_id):
+    """
+    Returns the fingerprint stored by the last successful pipeline run,
+    or None if there is none.
+    """
+    try:
+        cur.execute("SELECT fingerprint FROM pipeline_state WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error reading pipeline state: {error}")
+        return None
+
+def store_pipeline_fingerprint(cur, user_id, fingerprint):
+    """
+    Records the fingerprint of the mistake set a successful run analyzed.
+    """
+    try:
+        cur.execute(
+            """
+            INSERT INTO pipeline_state (user_id, fingerprint, last_run_at)
+            VALUES (%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE
+            SET fingerprint = EXCLUDED.fingerprint, last_run_at = EXCLUDED.last_run_at
+            """,
+            (user_id, fingerprint)
+        )
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error storing pipeline state: {error}")
+
 def get_all_mistakes_for_user_v6(cur, user_id):
     """
     Fetches ALL mistakes for a user, regardless of habit_id.
     This is the main dataset for HDBSCAN.
+
+    Streams the result through a server-side named cursor (itersize
+    chunks) straight into per-column lists, so peak memory is one chunk
+    of row tuples plus the columnar output the DataFrame constructor
+    consumes directly - never the full result set as tuples at once.
     """
-    sql = """
-    SELECT 
-        id, cpl, move_number, -- Numeric features
-        mistake_type, mistake_category, game_phase, material_balance, -- Categorical features
-        board_complexity, king_self_safety, king_opponent_status, 
-        castling_status_self, piece_moved, move_type, piece_was_attacked, 
-        piece_was_defended, piece_was_defending, piece_was_pinned
+    sql = f"""
+    SELECT {', '.join(MISTAKE_FEATURE_COLUMNS)}
     FROM mistakes
-    WHERE game_id IN (SELECT id FROM games WHERE user_id = %s);
+    WHERE game_id IN (SELECT id FROM games WHERE user_id = %s)
+    ORDER BY id;
     """
+    columns = {col: [] for col in MISTAKE_FEATURE_COLUMNS}
     try:
-        with cur.connection.cursor(cursor_factory=RealDictCursor) as dict_cur:
-            dict_cur.execute(sql, (user_id,))
-            mistakes = dict_cur.fetchall()
-        print(f"Fetched {len(mistakes)} total mistakes for user {user_id} for clustering.")
-        return [dict(row) for row in mistakes]
+        with cur.connection.cursor(name='mistakes_stream') as stream_cur:
+            stream_cur.itersize = 5000
+            stream_cur.execute(sql, (user_id,))
+            while True:
+                chunk = stream_cur.fetchmany(stream_cur.itersize)
+                if not chunk:
+                    break
+                # Transpose the chunk once instead of indexing per cell
+                for col, values in zip(MISTAKE_FEATURE_COLUMNS, zip(*chunk)):
+                    columns[col].extend(values)
+        print(f"Fetched {len(columns['id'])} total mistakes for user {user_id} for clustering.")
+        return columns
     except (Exception, psycopg2.DatabaseError) as error:
         print(f"Error fetching all mistakes: {error}")
-        return []
+        return {col: [] for col in MISTAKE_FEATURE_COLUMNS}
 
-def link_mistakes_to_habit(cur, new_serial_habit_id, list_of_mistake_ids):
+def batch_save_habit_analysis(cur, user_id, habit_entries):
     """
-    Updates the 'habit_id' for a list of mistakes.
-    This is called *after* a new habit is created.
+    Saves all habits, their feedback rows, and their mistake links for
+    one pipeline run in three statements total (habits INSERT, feedback
+    INSERT, mistakes UPDATE) instead of multiple round trips per habit.
+    Returns the number of habits actually inserted.
     """
-    if not list_of_mistake_ids:
-        print("No mistake IDs to link.")
-        return
+    if not habit_entries:
+        return 0
 
-    # Create a list of tuples: (new_serial_habit_id, mistake_id)
-    data_to_update = [(new_serial_habit_id, mistake_id) for mistake_id in list_of_mistake_ids]
+    try:
+        habit_rows = []
+        for entry in habit_entries:
+            cluster_id = int(entry['cluster_id'])
+            confidence = float(entry['confidence']) # Must convert numpy float to standard float
+            description = f"HDBSCAN Cluster {cluster_id} ({confidence * 100:.0f}% confidence)"
+            habit_rows.append((
+                user_id, entry['habit_name'], description, cluster_id,
+                confidence, json.dumps(entry['triggers']), int(entry['prime_example_id'])
+            ))
 
-    update_sql = """
-    UPDATE mistakes AS m
-    SET habit_id = data.habit_id
-    FROM (VALUES %s) AS data(habit_id, mistake_id)
-    WHERE m.id = data.mistake_id;
-    """
+        # 1. --- Save ML/Clustering Data to 'habits' table ---
+        inserted = execute_values(cur, """
+            INSERT INTO habits
+                (user_id, habit_name, description, cluster_id, confidence, triggers_json, prime_example_mistake_id)
+            VALUES %s
+            ON CONFLICT (user_id, habit_name) DO NOTHING
+            RETURNING id, habit_name;
+            """, habit_rows, fetch=True)
+        habit_id_by_name = {habit_name: habit_id for habit_id, habit_name in inserted}
+
+        # 2. --- Collect LLM feedback rows and mistake links per new habit ---
+        feedback_rows = []
+        link_rows = []
+        for entry in habit_entries:
+            habit_id = habit_id_by_name.get(entry['habit_name'])
+            if habit_id is None:
+                print(f"Habit '{entry['habit_name']}' already exists in DB. Skipping analysis save.")
+                continue
+            feedback_rows.append((
+                habit_id,
+                entry['feedback_text'],    # Value for DB column: feedback_text
+                entry['feedback_text'],    # Value for DB column: coaching_feedback
+                entry['improvement_tip']   # Value for DB column: improvement_tip
+            ))
+            link_rows.extend((habit_id, mistake_id) for mistake_id in entry['mistake_ids'])
+
+        if feedback_rows:
+            execute_values(cur, """
+                INSERT INTO feedback
+                    (habit_id, feedback_text, coaching_feedback, improvement_tip)
+                VALUES %s;
+                """, feedback_rows)
+
+        if link_rows:
+            execute_values(cur, """
+                UPDATE mistakes AS m
+                SET habit_id = data.habit_id
+                FROM (VALUES %s) AS data(habit_id, mistake_id)
+                WHERE m.id = data.mistake_id;
+                """, link_rows)
+            print(f"Linked {len(link_rows)} mistakes to {len(feedback_rows)} new habits.")
+
+        return len(feedback_rows)
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error batch-saving habit analysis: {error}")
+        return 0
     
+def get_cached_feedback(cur, cache_key):
+    """
+    Looks up a previously generated LLM feedback blob for a habit's
+    statistical profile. Returns the parsed dict or None on a miss.
+    """
     try:
-        execute_values(cur, update_sql, data_to_update)
-        print(f"Linked {len(list_of_mistake_ids)} mistakes to new habit_id {new_serial_habit_id}.")
+        cur.execute("SELECT feedback FROM habit_feedback_cache WHERE cache_key = %s", (cache_key,))
+        row = cur.fetchone()
+        return row[0] if row else None
     except (Exception, psycopg2.DatabaseError) as error:
-        print(f"Error linking mistakes to habit: {error}")
-        # This will rollback the transaction in main_analysis_pipeline
+        print(f"Error reading feedback cache: {error}")
+        return None
 
-def save_habit_analysis(cur, user_id, hdbscan_cluster_id, habit_name, triggers, confidence, prime_example_id, feedback_text, improvement_tip):
+def store_cached_feedback(cur, cache_key, feedback):
     """
-    Saves the results of the analysis to the 'habits' and 'feedback' tables.
-    Returns the new 'habit' table ID (the serial key).
+    Persists one LLM feedback blob under its profile hash.
     """
     try:
-        # Assuming int/float conversions are already handled:
-        hdbscan_cluster_id_int = int(hdbscan_cluster_id)
-        prime_example_id_int = int(prime_example_id)
-        confidence_float = float(confidence) # Must convert numpy float to standard float
-        
-        # 1. --- Save ML/Clustering Data to 'habits' table ---
-        habit_sql = """
-        INSERT INTO habits 
-            (user_id, habit_name, description, cluster_id, confidence, triggers_json, prime_example_mistake_id)
-        VALUES 
-            (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (user_id, habit_name) DO NOTHING
-        RETURNING id;
-        """
-        description = f"HDBSCAN Cluster {hdbscan_cluster_id_int} ({confidence_float * 100:.0f}% confidence)"
-        triggers_json = json.dumps(triggers)
-        
-        cur.execute(habit_sql, (
-            user_id, habit_name, description, 
-            hdbscan_cluster_id_int, confidence_float, triggers_json, prime_example_id_int
-        ))
-        
-        habit_id_row = cur.fetchone()
-        if not habit_id_row:
-             print(f"Habit '{habit_name}' already exists in DB. Skipping analysis save.")
-             return None
-             
-        new_serial_habit_id = habit_id_row[0]
-
-        # 2. --- Save LLM Feedback to 'feedback' table ---
-        feedback_sql = """
-        INSERT INTO feedback 
-            (habit_id, feedback_text, coaching_feedback, improvement_tip)
-        VALUES 
-            (%s, %s, %s, %s);  -- 4 placeholders
-        """
-        
         cur.execute(
-            feedback_sql, 
-            (
-                new_serial_habit_id, 
-                feedback_text,         # Value for DB column: feedback_text
-                feedback_text,         # Value for DB column: coaching_feedback
-                improvement_tip        # Value for DB column: improvement_tip
-            )
+            """
+            INSERT INTO habit_feedback_cache (cache_key, feedback)
+            VALUES (%s, %s)
+            ON CONFLICT (cache_key) DO NOTHING
+            """,
+            (cache_key, json.dumps(feedback))
         )
-        
-        print(f"Saved analysis for new habit {new_serial_habit_id} (Cluster {hdbscan_cluster_id}).")
-        return new_serial_habit_id
-        
     except (Exception, psycopg2.DatabaseError) as error:
-        print(f"Error saving habit analysis: {error}")
-        return None
-    
+        print(f"Error writing feedback cache: {error}")
+
 def get_all_habits_for_user(cur, user_id):
     cur.execute("""
         SELECT 
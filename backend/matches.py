@@ -1,13 +1,27 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import chess
 import chess.pgn
 import chess.engine
+import chess.polyglot
+import shelve
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from dotenv import load_dotenv
 import os
 from datetime import datetime
 from . import db_helpers # Import the helper file
 
+try:
+    # Incremental JSON parser - optional, lets the archive stream instead
+    # of materializing the whole month's response at once
+    import ijson
+except ImportError:
+    ijson = None
+
 # --- Constants ---
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path)
@@ -15,6 +29,17 @@ load_dotenv(dotenv_path)
 CHESS_COM_API_URL = os.environ.get('CHESS_COM_API_URL')
 CHESS_USER_AGENT = os.environ.get('CHESS_USER_AGENT')
 
+# One pooled session for all chess.com API calls: reuses TCP+TLS
+# connections across months (the handshake dominates otherwise) and
+# retries transient failures with backoff.
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": CHESS_USER_AGENT})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])
+))
+
 # CPL thresholds
 CPL_BLUNDER = 300
 CPL_MISTAKE = 100
@@ -23,6 +48,10 @@ CPL_INACCURACY = 50
 # Tactic definition
 TACTIC_DIFFERENCE_THRESHOLD = 150 # 1.5 pawns difference between best and 2nd best move
 
+# Games faster than this base time (seconds) aren't worth 0.1s/ply of
+# engine time - bullet move quality is mostly noise for habit analysis
+MIN_BASE_TIME_SECONDS = 180
+
 PIECE_VALUES = {
     chess.PAWN: 1,
     chess.KNIGHT: 3,
@@ -32,22 +61,139 @@ PIECE_VALUES = {
     chess.KING: 100 # Internal value, not for material count
 }
 
+# chess.PIECE_NAMES upper-cased once, indexed by piece type (slot 0 is
+# None in python-chess, hence the UNKNOWN placeholder)
+PIECE_NAME_UPPER = tuple(
+    name.upper() if name else 'UNKNOWN' for name in chess.PIECE_NAMES
+)
+
+# Process-wide transposition table for engine analysis, keyed by the
+# position's Zobrist hash (side to move and castling rights are baked in)
+# plus the multipv setting. Openings repeat constantly across a user's
+# games, so cache hits skip the 0.1s engine call entirely. Evicts oldest
+# entries first once full; persists across process_user_games calls.
+ANALYSIS_TT = OrderedDict()
+ANALYSIS_TT_MAX = 1_000_000
+
+# On-disk write-through copy of the transposition table, so repeated
+# imports (the same user re-analyzed monthly) start warm instead of
+# re-searching every opening position. Neither the shelf nor the
+# OrderedDict's get/move_to_end/evict sequences are thread-safe, and the
+# engine-pool workers all share them, so every access to either tier
+# goes through the lock; analysis results pickle cleanly.
+TT_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'cache', 'analysis_tt')
+_TT_LOCK = threading.Lock()
+try:
+    os.makedirs(os.path.dirname(TT_CACHE_PATH), exist_ok=True)
+    _TT_SHELF = shelve.open(TT_CACHE_PATH)
+except Exception as e:
+    print(f"Persistent analysis cache unavailable ({e}); using memory only.")
+    _TT_SHELF = None
+
+# The analysis code only ever reads 'score' and 'pv'; telling python-chess
+# so skips parsing the other UCI info fields (depth, nodes, nps, ...) on
+# the dozens of info lines Stockfish emits per search.
+ANALYSIS_INFO = chess.engine.INFO_SCORE | chess.engine.INFO_PV
+
+# Search budget per analysed position; immutable, so one shared instance
+ANALYSIS_LIMIT = chess.engine.Limit(time=0.1)
+
+def _analyse_cached(engine, board, limit, multipv=None):
+    """
+    engine.analyse behind two cache tiers: the in-memory transposition
+    table, then the persistent shelf. Fresh results are written through
+    to both.
+    """
+    key = (chess.polyglot.zobrist_hash(board), multipv)
+    with _TT_LOCK:
+        cached = ANALYSIS_TT.get(key)
+        if cached is not None:
+            ANALYSIS_TT.move_to_end(key)
+            return cached
+
+        shelf_key = f"{key[0]}:{multipv}"
+        if _TT_SHELF is not None:
+            cached = _TT_SHELF.get(shelf_key)
+            if cached is not None:
+                _tt_remember(key, cached)
+                return cached
+
+    if multipv is None:
+        result = engine.analyse(board, limit, info=ANALYSIS_INFO)
+    else:
+        result = engine.analyse(board, limit, multipv=multipv, info=ANALYSIS_INFO)
+
+    with _TT_LOCK:
+        _tt_remember(key, result)
+        if _TT_SHELF is not None:
+            _TT_SHELF[shelf_key] = result
+    return result
+
+def _tt_remember(key, result):
+    """
+    Stores one analysis in the in-memory table, evicting oldest-first.
+    Callers must hold _TT_LOCK.
+    """
+    ANALYSIS_TT[key] = result
+    if len(ANALYSIS_TT) > ANALYSIS_TT_MAX:
+        ANALYSIS_TT.popitem(last=False)
+
 # --- Chess.com API Functions ---
 
 def get_player_matches(username, year, month):
     """
-    Fetches all games for a given user from the Chess.com API.
+    Yields each game for a given user from the Chess.com API.
+
+    A month's archive can run to several MB; with ijson installed the
+    games are parsed incrementally off the wire, so peak memory is one
+    game rather than the whole response. Falls back to response.json()
+    when ijson is unavailable.
     """
     url = f"{CHESS_COM_API_URL}/{username}/games/{year:04d}/{month:02d}"
-    headers = {"User-Agent": CHESS_USER_AGENT}
     print(f"Requesting URL: {url}")
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status() 
-        return response.json()
+        response = _SESSION.get(url, timeout=30, stream=ijson is not None)
+        response.raise_for_status()
+        if ijson is not None:
+            response.raw.decode_content = True # Un-gzip for the parser
+            yield from ijson.items(response.raw, 'games.item')
+        else:
+            yield from response.json().get("games", [])
     except requests.exceptions.RequestException as e:
         print(f"Error fetching games for {username}: {e}")
+
+def pgn_read_headers(pgn_file):
+    """
+    Parses just the header section of a PGN string - no move tree.
+    """
+    if not pgn_file:
         return None
+    try:
+        return chess.pgn.read_headers(StringIO(pgn_file))
+    except Exception as e:
+        print(f"Error parsing PGN headers: {e}")
+        return None
+
+def is_game_worth_analyzing(headers):
+    """
+    Filters out games where engine analysis is wasted effort: bullet
+    time controls, abandoned games, and games without a result.
+    """
+    if headers.get("Result", "") == "*":
+        return False
+    if "abandoned" in headers.get("Termination", "").lower():
+        return False
+
+    tc = headers.get("TimeControl", "")
+    if tc and '/' not in tc: # '1/86400'-style daily games always pass
+        try:
+            base_seconds = int(tc.split('+', 1)[0])
+            if base_seconds < MIN_BASE_TIME_SECONDS:
+                return False
+        except ValueError:
+            pass # Unrecognized time control - analyze rather than drop
+
+    return True
 
 def pgn_parse(pgn_file):
     """
@@ -84,91 +230,105 @@ def analyze_game_fully(game, username, engine):
         print(f"Error: User {username} not found in game headers.")
         return []
 
-    print(f"Analyzing game as {chess.COLOR_NAMES[user_color]} ({username})...")
+    user_color_name = chess.COLOR_NAMES[user_color]
+    print(f"Analyzing game as {user_color_name} ({username})...")
 
     for move in game.mainline_moves():
-        
-        prior_fen = board.fen()
-        
-        if board.turn == user_color:
-            
-            if board.is_game_over():
-                print(f"Move {board.fullmove_number}: Game is over, skipping analysis.")
-                board.push(move) 
-                continue       
-            
-            analysis_limit = chess.engine.Limit(time=0.1)
-            analysis = None
-            try:
-                analysis = engine.analyse(board, analysis_limit, multipv=2)
-            except Exception as e:
-                print(f"ERROR during engine.analyse: {e}. FEN: {prior_fen}")
 
-            
-            # --- FIX #1: Check for 'pv' (Principal Variation) list, not 'move' ---
-            if not analysis or 'pv' not in analysis[0] or not analysis[0]['pv']:
-                print(f"No valid analysis for move {board.fullmove_number} ({chess.COLOR_NAMES[board.turn]}). FEN: {prior_fen}. Analysis result: {analysis}")
-            
-            else:
-                # --- Analysis was successful ---
-                best_move_info = analysis[0]
-                
-                # --- FIX #2: Get the best move from the 'pv' list ---
-                best_move = best_move_info['pv'][0] 
-                best_score = best_move_info['score'].relative.score(mate_score=10000)
-                
-                user_move_score = None
-                
-                # --- FIX #3: Check the 'pv' list in the loop ---
-                for move_info in analysis:
-                    if 'pv' in move_info and move_info['pv'] and move_info['pv'][0] == move:
-                        user_move_score = move_info['score'].relative.score(mate_score=10000)
-                        break
-                
-                if user_move_score is None:
-                    # User's move was not in the top 2, analyze it specifically
-                    board.push(move) 
-                    user_analysis = engine.analyse(board, analysis_limit)
-                    
-                    if user_analysis['score'].is_mate():
-                         user_move_score = -user_analysis['score'].relative.score(mate_score=10000)
-                    else:
-                         user_move_score = user_analysis['score'].relative.score(mate_score=10000) * -1
-                    
-                    board.pop() 
-
-                cpl = max(0, best_score - user_move_score)
-                mistake_type = get_mistake_type(cpl)
-
-                if mistake_type != "Good":
-                    print(f"Found mistake! Move: {board.fullmove_number}, Type: {mistake_type}, CPL: {cpl}")
-                    
-                    moved_piece = board.piece_at(move.from_square)
-                    
-                    mistake_data = {
-                        "move_number": board.fullmove_number,
-                        "player_color": chess.COLOR_NAMES[user_color],
-                        "prior_fen": prior_fen,
-                        "move_made": move.uci(),
-                        "best_move": best_move.uci(),
-                        "cpl": cpl,
-                        "mistake_type": mistake_type,
-                        "mistake_category": get_mistake_category(board, move, analysis),
-                        "game_phase": get_game_phase(board),
-                        "material_balance": get_material_balance(board, user_color),
-                        "board_complexity": get_board_complexity(board),
-                        "king_self_safety": get_king_safety(board, user_color),
-                        "king_opponent_status": get_king_safety(board, not user_color),
-                        "castling_status_self": get_castling_status(board, user_color),
-                        "piece_moved": chess.PIECE_NAMES[moved_piece.piece_type].upper() if moved_piece else 'UNKNOWN',
-                        "move_type": get_move_type(board, move),
-                        "piece_was_attacked": board.is_attacked_by(not user_color, move.from_square),
-                        "piece_was_defended": board.is_attacked_by(user_color, move.from_square),
-                        "piece_was_defending": is_piece_defending(board, move.from_square, user_color),
-                        "piece_was_pinned": board.is_pinned(user_color, move.from_square)
-                    }
-                    mistakes_list.append(mistake_data)
-        
+        # Opponent plies need no analysis at all - push and move on
+        if board.turn != user_color:
+            board.push(move)
+            continue
+
+        if board.is_game_over():
+            print(f"Move {board.fullmove_number}: Game is over, skipping analysis.")
+            board.push(move)
+            continue
+
+        analysis = None
+        try:
+            # multipv=3: one extra root move is cheap (shared search tree)
+            # and usually covers the played move, sparing the second
+            # full-length analyse below
+            analysis = _analyse_cached(engine, board, ANALYSIS_LIMIT, multipv=3)
+        except Exception as e:
+            print(f"ERROR during engine.analyse: {e}. FEN: {board.board_fen()}")
+
+
+        # --- FIX #1: Check for 'pv' (Principal Variation) list, not 'move' ---
+        if not analysis or 'pv' not in analysis[0] or not analysis[0]['pv']:
+            print(f"No valid analysis for move {board.fullmove_number} ({user_color_name}). FEN: {board.board_fen()}. Analysis result: {analysis}")
+
+        else:
+            # --- Analysis was successful ---
+            best_move_info = analysis[0]
+
+            # --- FIX #2: Get the best move from the 'pv' list ---
+            best_move = best_move_info['pv'][0]
+            best_score = best_move_info['score'].relative.score(mate_score=10000)
+
+            user_move_score = None
+
+            # --- FIX #3: Check the 'pv' list in the loop ---
+            for move_info in analysis:
+                if 'pv' in move_info and move_info['pv'] and move_info['pv'][0] == move:
+                    user_move_score = move_info['score'].relative.score(mate_score=10000)
+                    break
+
+            if user_move_score is None:
+                # User's move was not in the top 3, analyze it specifically
+                board.push(move)
+                user_analysis = _analyse_cached(engine, board, ANALYSIS_LIMIT)
+
+                if user_analysis['score'].is_mate():
+                     user_move_score = -user_analysis['score'].relative.score(mate_score=10000)
+                else:
+                     user_move_score = user_analysis['score'].relative.score(mate_score=10000) * -1
+
+                board.pop()
+
+            cpl = max(0, best_score - user_move_score)
+            mistake_type = get_mistake_type(cpl)
+
+            if mistake_type != "Good":
+                print(f"Found mistake! Move: {board.fullmove_number}, Type: {mistake_type}, CPL: {cpl}")
+
+                # Serialize the FEN lazily - only mistakes need it, and
+                # the board is still in its pre-push state here
+                prior_fen = board.fen()
+                from_square = move.from_square
+                moved_piece = board.piece_at(from_square)
+
+                # One attackers_mask per side; the attacked/defended
+                # booleans are emptiness tests on the raw ints instead
+                # of separate is_attacked_by attack-table walks
+                attacked_by_opponent = board.attackers_mask(not user_color, from_square)
+                defended_by_self = board.attackers_mask(user_color, from_square)
+
+                mistake_data = {
+                    "move_number": board.fullmove_number,
+                    "player_color": user_color_name,
+                    "prior_fen": prior_fen,
+                    "move_made": move.uci(),
+                    "best_move": best_move.uci(),
+                    "cpl": cpl,
+                    "mistake_type": mistake_type,
+                    "mistake_category": get_mistake_category(board, move, analysis),
+                    "game_phase": get_game_phase(board),
+                    "material_balance": get_material_balance(board, user_color),
+                    "board_complexity": get_board_complexity(board),
+                    "king_self_safety": get_king_safety(board, user_color),
+                    "king_opponent_status": get_king_safety(board, not user_color),
+                    "castling_status_self": get_castling_status(board, user_color),
+                    "piece_moved": PIECE_NAME_UPPER[moved_piece.piece_type] if moved_piece else 'UNKNOWN',
+                    "move_type": get_move_type(board, move),
+                    "piece_was_attacked": bool(attacked_by_opponent),
+                    "piece_was_defended": bool(defended_by_self),
+                    "piece_was_defending": is_piece_defending(board, from_square, user_color),
+                    "piece_was_pinned": board.is_pinned(user_color, from_square)
+                }
+                mistakes_list.append(mistake_data)
+
         board.push(move)
         
     return mistakes_list
@@ -202,34 +362,36 @@ def get_mistake_category(board, move, analysis):
 def is_move_a_hang(board, move):
     """
     Checks if a move results in hanging a piece or a bad trade.
+    Everything after the piece lookup is bitmask tests - no Python loop
+    over attacker squares.
     """
     to_square = move.to_square
     moved_piece = board.piece_at(move.from_square)
     if moved_piece is None: return False
-    
-    moved_piece_value = PIECE_VALUES[moved_piece.piece_type]
+
     user_color = board.turn
     opponent_color = not user_color
-    
-    opponent_attackers = board.attackers(opponent_color, to_square)
+
+    opponent_attackers = board.attackers_mask(opponent_color, to_square)
     if not opponent_attackers:
         return False # Not attacked, not a hang
 
-    our_defenders = board.attackers(user_color, to_square)
-    
-    if not our_defenders:
+    if not board.attackers_mask(user_color, to_square):
         return True # Attacked and undefended
 
-    lowest_attacker_value = 100
-    for attacker_square in opponent_attackers:
-        attacker_piece = board.piece_at(attacker_square)
-        if attacker_piece:
-            lowest_attacker_value = min(lowest_attacker_value, PIECE_VALUES[attacker_piece.piece_type])
-    
-    if moved_piece_value > lowest_attacker_value:
-        return True
+    # Cheapest attacker straight from the piece-type bitboards
+    if opponent_attackers & board.pawns:
+        lowest_attacker_value = 1
+    elif opponent_attackers & (board.knights | board.bishops):
+        lowest_attacker_value = 3
+    elif opponent_attackers & board.rooks:
+        lowest_attacker_value = 5
+    elif opponent_attackers & board.queens:
+        lowest_attacker_value = 9
+    else:
+        lowest_attacker_value = 100 # King is the only attacker
 
-    return False
+    return PIECE_VALUES[moved_piece.piece_type] > lowest_attacker_value
 
 def get_game_phase(board):
     pieces = len(board.piece_map())
@@ -240,14 +402,16 @@ def get_game_phase(board):
     return "Middlegame"
 
 def get_material_balance(board, user_color):
-    user_score = 0
-    opp_score = 0
-    for piece_type in PIECE_VALUES:
-        if piece_type == chess.KING: continue
-        user_score += len(board.pieces(piece_type, user_color)) * PIECE_VALUES[piece_type]
-        opp_score += len(board.pieces(piece_type, not user_color)) * PIECE_VALUES[piece_type]
-
-    diff = user_score - opp_score
+    # Pure integer popcounts on the piece bitboards; no SquareSet objects
+    minors = board.knights | board.bishops
+
+    def score(mask):
+        return ((board.pawns & mask).bit_count()
+                + 3 * (minors & mask).bit_count()
+                + 5 * (board.rooks & mask).bit_count()
+                + 9 * (board.queens & mask).bit_count())
+
+    diff = score(board.occupied_co[user_color]) - score(board.occupied_co[not user_color])
     if diff > 1.5: return "Winning"
     if diff < -1.5: return "Losing"
     return "Equal"
@@ -256,19 +420,21 @@ def get_king_safety(board, color):
     """A simple heuristic for king safety."""
     if board.is_check():
         return "In_Check"
-        
+
     king_square = board.king(color)
     if king_square is None: return "Safe" # Should not happen
-        
-    nearby_squares = board.attacks(king_square)
-    attackers = 0
-    for square in nearby_squares:
-        if board.is_attacked_by(not color, square):
-            attackers += 1
-            
+
+    # OR the opponent's attack sets into one mask, then a single AND +
+    # popcount covers the whole king ring - the old loop regenerated the
+    # opponent's attacks via is_attacked_by for each of up to 8 squares
+    opponent_attacks = 0
+    for square in chess.scan_reversed(board.occupied_co[not color]):
+        opponent_attacks |= board.attacks_mask(square)
+
+    attackers = (board.attacks_mask(king_square) & opponent_attacks).bit_count()
     if attackers > 3:
         return "Exposed"
-        
+
     return "Safe"
 
 def get_board_complexity(board):
@@ -310,88 +476,123 @@ def get_move_type(board, move):
     return "Quiet"
 
 def is_piece_defending(board, square, color):
-    """Check if the piece on 'square' is defending another piece."""
-    piece = board.piece_at(square)
-    if piece is None: return False
-    
-    # 1. Remove the piece temporarily
-    board.remove_piece_at(square)
-    
-    # 2. Check all other pieces of the same color
-    defended_any = False
-    for sq in board.pieces(piece.piece_type, color):
-        if board.is_attacked_by(not color, sq):
-            defended_any = True
-            break
-            
-    # 3. Put the piece back
-    board.set_piece_at(square, piece)
-    return defended_any
+    """
+    Check if the piece on 'square' is defending another piece: its attack
+    set covers at least one friendly piece. Pure bitboard AND - the old
+    remove/re-add probe mutated the board and invalidated python-chess's
+    internal caches (and only ever looked at same-type pieces).
+    """
+    if board.piece_at(square) is None: return False
+    return bool(board.attacks(square) & board.occupied_co[color])
 
 
 # --- Main Processing Function ---
 
-def process_user_games(username, year, month, engine, conn):
+def _analyze_game_with_pool(game_id, game_obj, username, engine_pool):
+    """
+    One worker task: borrows an engine from the pool, analyzes the game,
+    and returns its mistakes tagged with the game id.
+    """
+    engine = engine_pool.get()
+    try:
+        mistakes_from_game = analyze_game_fully(game_obj, username, engine)
+    finally:
+        engine_pool.put(engine)
+
+    for mistake_dict in mistakes_from_game:
+        mistake_dict['game_id'] = game_id
+    return mistakes_from_game
+
+def process_user_games(username, year, month, engine_pool, conn):
     """
     Main logic function. Fetches, analyzes, and saves games and mistakes.
-    This function EXPECTS an active engine and db connection.
+    This function EXPECTS a queue of active engines and a db connection.
+    New games are analyzed in parallel, one engine per worker thread
+    (each Stockfish process is CPU-bound in native code, so the GIL
+    does not serialize them); all DB work stays on this thread.
     """
-    
+
     all_mistakes_to_insert = []
-    games_processed_count = 0
-    
+
     with conn.cursor() as cur:
         # --- 1. Get User ID ---
         user_id = db_helpers.get_user_by_username(cur, username)
         if not user_id:
-            return 
-
-        # --- 2. Fetch Games from Chess.com ---
-        games_data = get_player_matches(username, year, month)
-        if not games_data or not games_data.get("games"):
-            print("No games found for this user and month.")
             return
 
-        # --- 3. Process Each Game ---
-        for i, game_json in enumerate(games_data["games"]):
+        # --- 2/3. Fetch Each Game and Read Its Headers (streamed) ---
+        # Only the headers are parsed here - no move tree. The expensive
+        # full parse is deferred until a game is known to be both new and
+        # worth analyzing.
+        games_to_insert = []
+        analyzable_pgns = {}
+        for i, game_json in enumerate(get_player_matches(username, year, month)):
             pgn = game_json.get("pgn")
             game_url = game_json.get("url")
-            game_obj = pgn_parse(pgn)
-            
-            if not game_obj:
+            headers = pgn_read_headers(pgn)
+
+            if not headers:
                 print(f"Skipping game {i+1} (PGN parse error).")
                 continue
-            
-            print(f"Processing game {i+1}/{len(games_data['games'])}...")
-            
-            # --- 4. Insert Game into 'games' table ---
-            game_date_str = game_obj.headers.get("UTCDate", "1970.01.01") + " " + game_obj.headers.get("UTCTime", "00:00:00")
+
+            print(f"Processing game {i+1}...")
+
+            game_date_str = headers.get("UTCDate", "1970.01.01") + " " + headers.get("UTCTime", "00:00:00")
             game_date_obj = datetime.strptime(game_date_str, '%Y.%m.%d %H:%M:%S')
             source_game_id = game_url.split('/')[-1]
-            
-            new_game_id = db_helpers.insert_game(
-                cur, user_id, 'chess.com', source_game_id, 
-                game_url, pgn, game_date_obj
-            )
-            
-            if not new_game_id:
-                continue # Game already existed, skip analysis
-                
-            games_processed_count += 1
-            
-            # --- 5. Analyze Game for Mistakes ---
-            # *** USE THE FULL ANALYSIS FUNCTION ***
-            mistakes_from_game = analyze_game_fully(game_obj, username, engine)
-            print(f"Found {len(mistakes_from_game)} mistakes in this game.")
-            
-            # --- 6. Prepare Mistakes for Batch Insert ---
-            for mistake_dict in mistakes_from_game:
-                mistake_dict['game_id'] = new_game_id
-                all_mistakes_to_insert.append(mistake_dict)
+
+            games_to_insert.append((user_id, 'chess.com', source_game_id, game_url, pgn, game_date_obj))
+
+            # Bullet/abandoned/unfinished games are still ingested but
+            # never handed to the engine
+            if is_game_worth_analyzing(headers):
+                analyzable_pgns[source_game_id] = pgn
+            else:
+                print(f"Skipping analysis for game {i+1} (bullet, abandoned, or unfinished).")
+
+        if not games_to_insert:
+            print("No games found for this user and month.")
+            return
+
+        # --- 4. Insert All Games in One Round Trip ---
+        # Only the rows actually inserted come back; games that already
+        # existed conflict away and are skipped for analysis.
+        new_game_ids = db_helpers.batch_insert_games(cur, games_to_insert)
+        already_ingested = len(games_to_insert) - len(new_game_ids)
+        if already_ingested:
+            print(f"{already_ingested} games already existed in DB. Skipping their analysis.")
+
+        # Full move-tree parse only for the new, analyzable games
+        games_to_analyze = []
+        for source_game_id, game_id in new_game_ids.items():
+            pgn = analyzable_pgns.get(source_game_id)
+            if pgn is None:
+                continue
+            game_obj = pgn_parse(pgn)
+            if game_obj:
+                games_to_analyze.append((game_id, game_obj))
+
+        # --- 5. Analyze New Games in Parallel ---
+        # *** USE THE FULL ANALYSIS FUNCTION, ONE ENGINE PER WORKER ***
+        if games_to_analyze:
+            n_workers = max(1, engine_pool.qsize())
+            print(f"Analyzing {len(games_to_analyze)} new games on {n_workers} engines...")
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                results = executor.map(
+                    lambda item: _analyze_game_with_pool(item[0], item[1], username, engine_pool),
+                    games_to_analyze
+                )
+                # --- 6. Prepare Mistakes for Batch Insert ---
+                for mistakes_from_game in results:
+                    print(f"Found {len(mistakes_from_game)} mistakes in this game.")
+                    all_mistakes_to_insert.extend(mistakes_from_game)
+
+            if _TT_SHELF is not None:
+                _TT_SHELF.sync() # Flush newly cached analyses to disk
 
         # --- 7. Perform Batch Insert ---
         if all_mistakes_to_insert:
-            print(f"\nQueueing {len(all_mistakes_to_insert)} total mistakes from {games_processed_count} new games for insert...")
+            print(f"\nQueueing {len(all_mistakes_to_insert)} total mistakes from {len(games_to_analyze)} new games for insert...")
             # This helper function MUST be updated
             db_helpers.batch_insert_mistakes(cur, all_mistakes_to_insert)
         else:
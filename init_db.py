@@ -59,8 +59,14 @@ def create_database_and_tables():
         conn = psycopg2.connect(database_url) # Use the original DATABASE_URL
         cur = conn.cursor()
 
-        # --- Create Users Table ---
-        create_users_table_sql = """
+        # --- Create All Tables in One Statement ---
+        # A single execute cuts ~15 round trips to 1, and the advisory
+        # xact lock serializes concurrent deploys running this script so
+        # the DROP/CREATE of 'mistakes' can't race.
+        create_schema_sql = """
+        SELECT pg_advisory_xact_lock(4711);
+
+        -- Users
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
             google_id VARCHAR(100) UNIQUE NOT NULL,
@@ -69,13 +75,9 @@ def create_database_and_tables():
             chess_com_username VARCHAR(100) UNIQUE NULL,
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
         );
-        """
-        print("Creating 'users' table (if it doesn't exist)...")
-        cur.execute(create_users_table_sql)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_google_id ON users(google_id);")
+        CREATE INDEX IF NOT EXISTS idx_users_google_id ON users(google_id);
 
-        # --- Create Games Table ---
-        create_games_table_sql = """
+        -- Games
         CREATE TABLE IF NOT EXISTS games (
             id SERIAL PRIMARY KEY,
             user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
@@ -88,15 +90,10 @@ def create_database_and_tables():
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
             UNIQUE(user_id, source, source_game_id)
         );
-        """
-        print("Creating 'games' table (if it doesn't exist)...")
-        cur.execute(create_games_table_sql)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_games_user_id ON games(user_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_games_game_date ON games(game_date);")
-
+        CREATE INDEX IF NOT EXISTS idx_games_user_id ON games(user_id);
+        CREATE INDEX IF NOT EXISTS idx_games_game_date ON games(game_date);
 
-        # --- Create Habits Table ---
-        create_habits_table_sql = """
+        -- Habits
         CREATE TABLE IF NOT EXISTS habits (
             id SERIAL PRIMARY KEY,
             user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
@@ -107,19 +104,11 @@ def create_database_and_tables():
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
             UNIQUE(user_id, habit_name)
         );
-        """
-        print("Creating 'habits' table (if it doesn't exist)...")
-        cur.execute(create_habits_table_sql)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_id ON habits(user_id);")
-
-        # --- Create Mistakes Table (NEW VERSION) ---
-        # First, drop the old table if it exists to ensure the new schema is applied
-        # CASCADE drops any dependent objects (like indexes) cleanly.
-        print("Dropping 'mistakes' table (if it exists) to apply new schema...")
-        cur.execute("DROP TABLE IF EXISTS mistakes CASCADE;")
-
-        # Now, create the new, detailed table
-        create_mistakes_table_sql = """
+        CREATE INDEX IF NOT EXISTS idx_habits_user_id ON habits(user_id);
+
+        -- Mistakes (NEW VERSION): drop the old table first so the new
+        -- schema is applied; CASCADE drops dependent objects cleanly
+        DROP TABLE IF EXISTS mistakes CASCADE;
         CREATE TABLE mistakes (
             id SERIAL PRIMARY KEY,
             game_id INTEGER NOT NULL REFERENCES games(id) ON DELETE CASCADE,
@@ -160,25 +149,38 @@ def create_database_and_tables():
             -- Timestamp
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
         );
-        """
-        print("Creating new 'mistakes' table...")
-        cur.execute(create_mistakes_table_sql)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_mistakes_game_id ON mistakes(game_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_mistakes_habit_id ON mistakes(habit_id);")
-      
-        # --- Create Feedback Table ---
-        create_feedback_table_sql = """
+        CREATE INDEX IF NOT EXISTS idx_mistakes_game_id ON mistakes(game_id);
+        CREATE INDEX IF NOT EXISTS idx_mistakes_habit_id ON mistakes(habit_id);
+
+        -- Feedback
         CREATE TABLE IF NOT EXISTS feedback (
             id SERIAL PRIMARY KEY,
             habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
             feedback_text TEXT NOT NULL,
             generated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
         );
-        """
-        print("Creating 'feedback' table (if it doesn't exist)...")
-        cur.execute(create_feedback_table_sql)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_feedback_habit_id ON feedback(habit_id);")
+        CREATE INDEX IF NOT EXISTS idx_feedback_habit_id ON feedback(habit_id);
+
+        -- Habit feedback cache: memoizes LLM feedback by a hash of the
+        -- habit's statistical profile, so re-runs with unchanged
+        -- clusters skip the OpenAI call
+        CREATE TABLE IF NOT EXISTS habit_feedback_cache (
+            cache_key TEXT PRIMARY KEY,
+            feedback JSONB NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
 
+        -- Pipeline state: one row per user with the fingerprint of the
+        -- mistake set the last successful analysis run saw, so unchanged
+        -- data can skip re-analysis
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            fingerprint TEXT NOT NULL,
+            last_run_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+        print("Creating all tables (if they don't exist)...")
+        cur.execute(create_schema_sql)
 
         # Commit the changes for table creation
         conn.commit()
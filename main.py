@@ -7,6 +7,7 @@ from dotenv import load_dotenv
 from google_auth_oauthlib.flow import Flow
 import requests
 import json
+import queue
 import traceback
 import chess.engine
 from datetime import date
@@ -52,28 +53,39 @@ def get_db():
             raise
     return g.db
 
-def get_engine():
-    """Opens a new Stockfish engine if there is none yet."""
-    if 'engine' not in g:
+# Number of Stockfish processes to run in parallel during game analysis.
+# Each is configured with Threads=1 so they don't oversubscribe cores.
+ENGINE_POOL_SIZE = min(4, os.cpu_count() or 1)
+
+def get_engine_pool():
+    """Opens a pool of Stockfish engines if there is none yet."""
+    if 'engine_pool' not in g:
+        pool = queue.Queue()
         try:
-            g.engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-            # Limit memory usage for Render backend Free tier
-            g.engine.configure({"Threads": 1, "Hash": 16})
+            for _ in range(ENGINE_POOL_SIZE):
+                engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+                # Limit memory usage for Render backend Free tier
+                engine.configure({"Threads": 1, "Hash": 16})
+                pool.put(engine)
         except Exception as e:
             print(f"Error starting Stockfish engine: {e}")
+            while not pool.empty():
+                pool.get().quit()
             raise
-    return g.engine
+        g.engine_pool = pool
+    return g.engine_pool
 
 @app.teardown_appcontext
 def close_connections(error):
-    """Closes database and engine at the end of the request."""
+    """Closes database and engines at the end of the request."""
     db = g.pop('db', None)
     if db is not None:
         db.close()
-        
-    engine = g.pop('engine', None)
-    if engine is not None:
-        engine.quit()
+
+    engine_pool = g.pop('engine_pool', None)
+    if engine_pool is not None:
+        while not engine_pool.empty():
+            engine_pool.get().quit()
 
 # --- User Class (to work with Flask-Login) ---
 # Most things LOGIN related are generated and debugged by Gemini
@@ -330,7 +342,7 @@ def analyze_games():
     db_conn = None
     try:
         db_conn = get_db()
-        engine = get_engine()
+        engine_pool = get_engine_pool()
 
         # 2. Parse the YYYY-MM strings into date objects
         start_year, start_month = map(int, start_month_year.split('-'))
@@ -348,7 +360,7 @@ def analyze_games():
             print(f"Running ingest for {chess_username} - Month: {year}-{month:02d}...")
             
             # 4. Call the processing function for the current month
-            matches.process_user_games(chess_username, year, month, engine, db_conn)
+            matches.process_user_games(chess_username, year, month, engine_pool, db_conn)
             
             print(f"Ingest complete for {year}-{month:02d}.")
             